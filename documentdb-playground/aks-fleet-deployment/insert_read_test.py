@@ -1,75 +1,205 @@
 #!/usr/bin/env python3
 
+import argparse
+import asyncio
 import sys
 import time
 import uuid
-from datetime import datetime, timezone
-from pymongo import MongoClient
+from bson import ObjectId
+from pymongo import AsyncMongoClient
 from pymongo.errors import PyMongoError
+from pymongo.write_concern import WriteConcern
 
 
 def build_connection_string(ip: str, password: str, port: int = 10260) -> str:
     return f"mongodb://default_user:{password}@{ip}:{port}/?authMechanism=SCRAM-SHA-256&tls=true&tlsAllowInvalidCertificates=true"
 
 
-def main() -> int:
-    if len(sys.argv) != 5:
-        print("Usage: python insert_read_test.py <insert_ip> <read_ip_1> <read_ip_2> <password>")
-        return 1
-
-    insert_ip, read_ip_1, read_ip_2, password = sys.argv[1:5]
-
-    insert_client = MongoClient(build_connection_string(insert_ip, password))
-    read_client_1 = MongoClient(build_connection_string(read_ip_1, password))
-    read_client_2 = MongoClient(build_connection_string(read_ip_2, password))
+def build_replica_set_connection_string(ips: list, password: str, replica_set: str, port: int = 10260) -> str:
+    hosts = ",".join(f"{ip}:{port}" for ip in ips)
+    return f"mongodb://default_user:{password}@{hosts}/?replicaSet={replica_set}&authMechanism=SCRAM-SHA-256&tls=true&tlsAllowInvalidCertificates=true"
+
+
+# Table rows are written to stdout in blocks of this many lines
+OUTPUT_FLUSH_ROWS = 10
+
+
+def make_client(uri: str, **options) -> AsyncMongoClient:
+    # Short timeouts surface a failed primary quickly instead of hanging on
+    # the default server-selection timeout; compression trims bytes on the
+    # wire for the high-frequency insert/read loop.
+    return AsyncMongoClient(
+        uri,
+        maxPoolSize=256,
+        minPoolSize=16,
+        serverSelectionTimeoutMS=3000,
+        socketTimeoutMS=5000,
+        connectTimeoutMS=3000,
+        compressors="zstd,snappy,zlib",
+        retryWrites=True,
+        **options,
+    )
+
+
+def format_row(inserted_id: ObjectId, count: int, read_count_1: int, read_count_2: int) -> str:
+    return " ".join((
+        inserted_id.binary.hex().ljust(30),
+        str(count).ljust(15),
+        str(read_count_1).ljust(15),
+        str(read_count_2).ljust(15),
+    ))
+
+
+def flush_rows(rows: list) -> None:
+    if rows:
+        sys.stdout.write("\n".join(rows) + "\n")
+        sys.stdout.flush()
+        rows.clear()
+
+
+def build_documents(start: int, size: int) -> list:
+    # "timestamp" is stored as int64 milliseconds since the Unix epoch rather
+    # than a BSON date, which skips datetime construction and conversion.
+    now_ms = time.time_ns() // 1_000_000
+    return [
+        {
+            "count": count,
+            "message": f"Insert operation {count}",
+            "timestamp": now_ms,
+        }
+        for count in range(start, start + size)
+    ]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="insert/read test")
+    parser.add_argument("insert_ip")
+    parser.add_argument("read_ip_1")
+    parser.add_argument("read_ip_2")
+    parser.add_argument("password")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=100,
+        help="Documents inserted per iteration with one insert_many (1 = one insert per iteration)",
+    )
+    parser.add_argument(
+        "--replica-set",
+        help="Replica set name of the three IPs; only makes inserts follow the primary (reads still go to read_ip_1/read_ip_2)",
+    )
+    parser.add_argument("--quiet", action="store_true", help="Don't print a table row per iteration")
+    args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    return args
+
+
+async def main() -> int:
+    args = parse_args()
+    sys.stdout.reconfigure(line_buffering=False, write_through=False)
+
+    if args.replica_set:
+        # All three IPs are members of one replica set: inserts go through a
+        # replica-set client that follows the primary. Reads keep their own
+        # direct connection to each member, as in the default mode, so the
+        # two read columns keep reporting per-member counts.
+        insert_client = make_client(build_replica_set_connection_string(
+            [args.insert_ip, args.read_ip_1, args.read_ip_2], args.password, args.replica_set
+        ))
+        read_clients = [
+            make_client(build_connection_string(ip, args.password), directConnection=True)
+            for ip in (args.read_ip_1, args.read_ip_2)
+        ]
+        clients = [insert_client, *read_clients]
+        insert_db = insert_client.testdb
+        read_db_1, read_db_2 = (c.testdb for c in read_clients)
+    else:
+        clients = [
+            make_client(build_connection_string(ip, args.password))
+            for ip in (args.insert_ip, args.read_ip_1, args.read_ip_2)
+        ]
+        insert_db, read_db_1, read_db_2 = (c.testdb for c in clients)
 
     collection_name = f"testcollection_{uuid.uuid4().hex}"
-    insert_collection = insert_client.testdb[collection_name]
-    read_collection_1 = read_client_1.testdb[collection_name]
-    read_collection_2 = read_client_2.testdb[collection_name]
+    # Fire-and-forget inserts: this is a load generator, so don't wait for the
+    # primary to acknowledge each batch.
+    insert_collection = insert_db.get_collection(collection_name, write_concern=WriteConcern(w=0))
+    read_collection_1 = read_db_1.get_collection(collection_name)
+    read_collection_2 = read_db_2.get_collection(collection_name)
 
     print(f"Using collection: {collection_name}")
 
-    print(f"{'Inserted Document':<30} {'Insert Count':<15} {'Read1 Count':<15} {'Read2 Count':<15}")
-    print("-" * 85)
+    if not args.quiet:
+        print(f"{'Inserted Document':<30} {'Insert Count':<15} {'Read1 Count':<15} {'Read2 Count':<15}")
+        print("-" * 85)
 
-    start_time = time.time()
+    loop = asyncio.get_running_loop()
+    start_time = loop.time()
     end_time = start_time + (10 * 60)  # 10 minutes
+    deadline = start_time
+    rows = []
     count = 0
 
-    while time.time() < end_time:
+    while loop.time() < end_time:
         try:
-            doc = {
-                "count": count,
-                "message": f"Insert operation {count}",
-                "timestamp": datetime.now(timezone.utc),
-            }
-            result = insert_collection.insert_one(doc)
-            count += 1
-
-            read_count_1 = read_collection_1.count_documents({})
-            read_count_2 = read_collection_2.count_documents({})
-
-            print(f"{str(result.inserted_id):<30} {count:<15} {read_count_1:<15} {read_count_2:<15}")
+            docs = build_documents(count, args.batch_size)
+            # The insert and both replica reads are independent round-trips,
+            # so issue them together and wait for all three. Read failures are
+            # reported separately so they never discard the insert result. The
+            # read counts come from collection metadata and are only a progress
+            # estimate; the exact count_documents() is used for the final totals.
+            insert_task = asyncio.create_task(insert_collection.insert_many(docs, ordered=False))
+            read_result_1, read_result_2, result = await asyncio.gather(
+                read_collection_1.estimated_document_count(),
+                read_collection_2.estimated_document_count(),
+                insert_task,
+                return_exceptions=True,
+            )
+            if isinstance(result, BaseException):
+                raise result
+            count += len(result.inserted_ids)
+
+            read_errors = [r for r in (read_result_1, read_result_2) if isinstance(r, BaseException)]
+            if read_errors:
+                rows.append(f"Read error: {read_errors[0]}")
+                read_count_1 = -1
+                read_count_2 = -1
+            else:
+                read_count_1, read_count_2 = read_result_1, read_result_2
+
+            if not args.quiet:
+                rows.append(format_row(result.inserted_ids[-1], count, read_count_1, read_count_2))
         except PyMongoError as exc:
-            print(f"Mongo error: {exc}")
+            rows.append(f"Mongo error: {exc}")
         except Exception as exc:
-            print(f"Unexpected error: {exc}")
+            rows.append(f"Unexpected error: {exc}")
+
+        if len(rows) >= OUTPUT_FLUSH_ROWS:
+            flush_rows(rows)
 
-        time.sleep(1)
+        # Keep a fixed cadence: sleep only for what is left of this period,
+        # and don't try to catch up on periods that overran.
+        deadline += 1
+        now = loop.time()
+        if now < deadline:
+            await asyncio.sleep(deadline - now)
+        else:
+            deadline = now
 
+    flush_rows(rows)
     print(f"Completed {count} insert operations in 10 minutes")
-    final_read_count_1 = read_collection_1.count_documents({})
-    final_read_count_2 = read_collection_2.count_documents({})
+    final_read_count_1, final_read_count_2 = await asyncio.gather(
+        read_collection_1.count_documents({}),
+        read_collection_2.count_documents({}),
+    )
     print(f"Final read count (read_ip_1): {final_read_count_1}")
     print(f"Final read count (read_ip_2): {final_read_count_2}")
 
-    insert_client.close()
-    read_client_1.close()
-    read_client_2.close()
+    for client in clients:
+        await client.close()
 
     return 0
 
 
 if __name__ == "__main__":
-    raise SystemExit(main())
+    raise SystemExit(asyncio.run(main()))
@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
 import sys
 import time
 import uuid
-from datetime import datetime, timezone
 
-from pymongo import MongoClient
-from pymongo.errors import PyMongoError
+from bson import ObjectId
+from pymongo import AsyncMongoClient
+from pymongo.errors import BulkWriteError, PyMongoError
+from pymongo.write_concern import WriteConcern
 
 
 def build_connection_string(host: str, username: str, password: str, port: int, use_srv=False) -> str:
@@ -23,6 +25,77 @@ def build_connection_string(host: str, username: str, password: str, port: int,
         )
 
 
+# Table rows are written to stdout in blocks of this many lines
+OUTPUT_FLUSH_ROWS = 10
+
+
+def build_replica_set_connection_string(
+    hosts: list, username: str, password: str, port: int, replica_set: str
+) -> str:
+    seeds = ",".join(f"{host}:{port}" for host in hosts)
+    return (
+        f"mongodb://{username}:{password}@{seeds}/"
+        f"?replicaSet={replica_set}&authMechanism=SCRAM-SHA-256&tls=true&tlsAllowInvalidCertificates=true"
+    )
+
+
+def make_client(uri: str, **options) -> AsyncMongoClient:
+    # Short timeouts surface a failed primary quickly instead of hanging on
+    # the default server-selection timeout; compression trims bytes on the
+    # wire for the high-frequency insert/read loop.
+    return AsyncMongoClient(
+        uri,
+        maxPoolSize=256,
+        minPoolSize=16,
+        serverSelectionTimeoutMS=3000,
+        socketTimeoutMS=5000,
+        connectTimeoutMS=3000,
+        compressors="zstd,snappy,zlib",
+        retryWrites=True,
+        **options,
+    )
+
+
+def format_row(inserted_id: ObjectId, count: int, read_count_1: int, read_count_2: int) -> str:
+    return " ".join((
+        inserted_id.binary.hex().ljust(30),
+        str(count).ljust(15),
+        str(read_count_1).ljust(15),
+        str(read_count_2).ljust(15),
+    ))
+
+
+def flush_rows(rows: list) -> None:
+    if rows:
+        sys.stdout.write("\n".join(rows) + "\n")
+        sys.stdout.flush()
+        rows.clear()
+
+
+def build_documents(start: int, size: int) -> list:
+    # "timestamp" is stored as int64 milliseconds since the Unix epoch rather
+    # than a BSON date, which skips datetime construction and conversion.
+    now_ms = time.time_ns() // 1_000_000
+    return [
+        {
+            "count": count,
+            "message": f"Insert operation {count}",
+            "timestamp": now_ms,
+        }
+        for count in range(start, start + size)
+    ]
+
+
+async def timed(operation, loop: asyncio.AbstractEventLoop) -> tuple:
+    # Returns (result or raised exception, loop time when it finished), so
+    # the timestamp isn't delayed by operations gathered alongside it.
+    try:
+        result = await operation
+    except Exception as exc:
+        result = exc
+    return result, loop.time()
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="failure insert/read test")
     parser.add_argument("insert_host")
@@ -34,31 +107,83 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--duration-seconds", type=int, default=600)
     parser.add_argument("--sleep-seconds", type=float, default=0.2)
     parser.add_argument("--port", type=int, default=10260)
-    return parser.parse_args()
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Documents inserted per iteration with one insert_many (1 = one insert per iteration)",
+    )
+    parser.add_argument(
+        "--fast-insert",
+        action="store_true",
+        help="Insert with write concern w=0 (unacknowledged); data-loss numbers are not meaningful",
+    )
+    parser.add_argument(
+        "--replica-set",
+        help="Replica set name of the three hosts; only makes inserts follow the primary (reads still go to read_host_1/read_host_2)",
+    )
+    parser.add_argument("--quiet", action="store_true", help="Don't print a table row per iteration")
+    args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    if args.replica_set and args.use_srv:
+        parser.error("--replica-set takes the member hosts directly and can't be combined with --use-srv")
+    return args
 
 
-def main() -> int:
+async def main() -> int:
     args = parse_args()
+    sys.stdout.reconfigure(line_buffering=False, write_through=False)
 
-    insert_client = MongoClient(
-        build_connection_string(args.insert_host, args.username, args.password, args.port, args.use_srv)
-    )
-    read_client_1 = MongoClient(
-        build_connection_string(args.read_host_1, args.username, args.password, args.port)
-    )
-    read_client_2 = MongoClient(
-        build_connection_string(args.read_host_2, args.username, args.password, args.port)
-    )
+    if args.replica_set:
+        # All three hosts are members of one replica set: inserts go through
+        # a replica-set client that follows primary changes. Reads keep their
+        # own direct connection to each member, as in the default mode, so
+        # the per-host read counts and data-loss numbers refer to that host.
+        insert_client = make_client(
+            build_replica_set_connection_string(
+                [args.insert_host, args.read_host_1, args.read_host_2],
+                args.username, args.password, args.port, args.replica_set,
+            )
+        )
+        read_clients = [
+            make_client(
+                build_connection_string(host, args.username, args.password, args.port),
+                directConnection=True,
+            )
+            for host in (args.read_host_1, args.read_host_2)
+        ]
+        clients = [insert_client, *read_clients]
+        insert_db = insert_client.testdb
+        read_db_1, read_db_2 = (c.testdb for c in read_clients)
+    else:
+        clients = [
+            make_client(
+                build_connection_string(args.insert_host, args.username, args.password, args.port, args.use_srv)
+            ),
+            make_client(
+                build_connection_string(args.read_host_1, args.username, args.password, args.port)
+            ),
+            make_client(
+                build_connection_string(args.read_host_2, args.username, args.password, args.port)
+            ),
+        ]
+        insert_db, read_db_1, read_db_2 = (c.testdb for c in clients)
 
     collection_name = f"testcollection_{uuid.uuid4().hex}"
-    insert_collection = insert_client.testdb[collection_name]
-    read_collection_1 = read_client_1.testdb[collection_name]
-    read_collection_2 = read_client_2.testdb[collection_name]
+    # Data-loss accounting relies on acknowledged inserts, so w=0 is opt-in.
+    write_concern = WriteConcern(w=0) if args.fast_insert else None
+    insert_collection = insert_db.get_collection(collection_name, write_concern=write_concern)
+    read_collection_1 = read_db_1.get_collection(collection_name)
+    read_collection_2 = read_db_2.get_collection(collection_name)
 
     print(f"Using collection: {collection_name}")
 
-    start_time = time.time()
+    loop = asyncio.get_running_loop()
+    start_time = loop.time()
     end_time = start_time + args.duration_seconds
+    deadline = start_time
+    rows = []
 
     successful_inserts = 0
     last_success_time = None
@@ -66,49 +191,78 @@ def main() -> int:
     first_failure_time = None
     recovery_time = None
 
-    print(f"{'Inserted Document':<30} {'Insert Count':<15} {'Read1 Count':<15} {'Read2 Count':<15}")
-    print("-" * 85)
+    if not args.quiet:
+        print(f"{'Inserted Document':<30} {'Insert Count':<15} {'Read1 Count':<15} {'Read2 Count':<15}")
+        print("-" * 85)
 
-    while time.time() < end_time:
+    while loop.time() < end_time:
         try:
-            now = datetime.now(timezone.utc)
-            doc = {
-                "count": successful_inserts,
-                "message": f"Insert operation {successful_inserts}",
-                "timestamp": now,
-            }
-            result = insert_collection.insert_one(doc)
-            successful_inserts += 1
-            last_success_time = time.time()
+            docs = build_documents(successful_inserts, args.batch_size)
+            # The insert and both replica reads are independent round-trips,
+            # so issue them together. Read failures are reported separately
+            # and must not count against insert availability. The read counts
+            # come from collection metadata and are only a progress estimate;
+            # the exact count_documents() is used for the data-loss check.
+            # Success and failure times come from when the insert itself
+            # finished, so slow replica reads don't count as downtime.
+            read_result_1, read_result_2, (result, insert_done_time) = await asyncio.gather(
+                read_collection_1.estimated_document_count(),
+                read_collection_2.estimated_document_count(),
+                timed(insert_collection.insert_many(docs, ordered=False), loop),
+                return_exceptions=True,
+            )
+            if isinstance(result, BulkWriteError):
+                # Unordered batches keep going past a failed document, so
+                # credit the ones the server acknowledged before failing.
+                successful_inserts += result.details.get("nInserted", 0)
+            if isinstance(result, BaseException):
+                if first_failure_time is None:
+                    first_failure_time = insert_done_time
+                    last_success_before_failure = last_success_time
+                raise result
+            successful_inserts += len(result.inserted_ids)
+            last_success_time = insert_done_time
             if first_failure_time is not None and recovery_time is None:
                 recovery_time = last_success_time
 
-            try:
-                read_count_1 = read_collection_1.count_documents({})
-                read_count_2 = read_collection_2.count_documents({})
-            except PyMongoError as exc:
-                print(f"Read error: {exc}")
+            read_errors = [r for r in (read_result_1, read_result_2) if isinstance(r, BaseException)]
+            if read_errors:
+                rows.append(f"Read error: {read_errors[0]}")
                 read_count_1 = -1
                 read_count_2 = -1
+            else:
+                read_count_1, read_count_2 = read_result_1, read_result_2
 
-            print(
-                f"{str(result.inserted_id):<30} {successful_inserts:<15} {read_count_1:<15} {read_count_2:<15}"
-            )
+            if not args.quiet:
+                rows.append(format_row(result.inserted_ids[-1], successful_inserts, read_count_1, read_count_2))
         except PyMongoError as exc:
             if first_failure_time is None:
-                first_failure_time = time.time()
+                first_failure_time = loop.time()
                 last_success_before_failure = last_success_time
-            print(f"Mongo error: {exc}")
+            rows.append(f"Mongo error: {exc}")
         except Exception as exc:
             if first_failure_time is None:
-                first_failure_time = time.time()
+                first_failure_time = loop.time()
                 last_success_before_failure = last_success_time
-            print(f"Unexpected error: {exc}")
+            rows.append(f"Unexpected error: {exc}")
+
+        if len(rows) >= OUTPUT_FLUSH_ROWS:
+            flush_rows(rows)
 
-        time.sleep(args.sleep_seconds)
+        # Keep a fixed cadence: sleep only for what is left of this period,
+        # and don't try to catch up on periods that overran.
+        deadline += args.sleep_seconds
+        now = loop.time()
+        if now < deadline:
+            await asyncio.sleep(deadline - now)
+        else:
+            deadline = now
 
-    final_read_count_1 = read_collection_1.count_documents({})
-    final_read_count_2 = read_collection_2.count_documents({})
+    flush_rows(rows)
+    final_read_count_1, final_read_count_2 = await asyncio.gather(
+        read_collection_1.count_documents({}),
+        read_collection_2.count_documents({}),
+    )
 
     print(f"Completed {successful_inserts} insert operations")
     print(f"Final read count (read_host_1): {final_read_count_1}")
@@ -125,12 +279,11 @@ def main() -> int:
     else:
         print("Downtime (s): N/A")
 
-    insert_client.close()
-    read_client_1.close()
-    read_client_2.close()
+    for client in clients:
+        await client.close()
 
     return 0
 
 
 if __name__ == "__main__":
-    sys.exit(main())
+    sys.exit(asyncio.run(main()))
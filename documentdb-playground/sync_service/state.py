@@ -5,25 +5,80 @@ Provides crash-safe persistence of resume tokens to enable catching up
 after program restarts or failures.
 """
 
-import json
+import copy
 import os
+import queue
 import tempfile
+import threading
 import logging
 from pathlib import Path
-from typing import Optional, Dict, Any
-from datetime import datetime
+from typing import Optional, Dict, Any, List, Set, Tuple
+from datetime import datetime, timezone
+
+import msgpack
+import orjson
+from bson import json_util
 
 logger = logging.getLogger(__name__)
 
+# Write a full snapshot once every this many persists; the ones in between
+# only write the resume tokens changed since the last full snapshot.
+FULL_SNAPSHOT_INTERVAL = 10
+
+# Stats counter incremented by record_operation() for each operation type
+_OP_KEY = {
+    "insert": "inserts",
+    "update": "updates",
+    "replace": "updates",
+    "delete": "deletes",
+    "error": "errors"
+}
+
+# fdatasync skips flushing unrelated metadata (e.g. mtime); it is not
+# available on every platform
+_sync_file_data = getattr(os, "fdatasync", os.fsync)
+
+
+def _bson_default(obj: Any) -> Any:
+    """
+    Encode BSON values (e.g. Binary in a resume token) as extended JSON so
+    they round-trip without losing their type or subtype.
+    """
+    if isinstance(obj, dict):
+        # dict subclasses such as SON are rejected by msgpack's strict_types
+        return dict(obj)
+    return json_util.default(obj)
+
+
+def _utc_timestamp() -> str:
+    """Current UTC time as an ISO 8601 string with second precision."""
+    return datetime.now(timezone.utc).isoformat(timespec="seconds").replace("+00:00", "Z")
+
 
 class SyncState:
     """
     Manages persistent state for change stream synchronization.
     
-    Stores per-collection resume tokens and sync metadata in a JSON file
-    with atomic writes to prevent corruption on crashes.
+    Stores per-collection resume tokens and sync metadata in a msgpack
+    file with atomic writes to prevent corruption on crashes. A JSON state
+    file left by an earlier version is migrated on first load.
+    
+    Every resume token update is also appended to a companion log file
+    (<state_file>.log, one JSON object per line) so tokens advanced since
+    the last snapshot survive a process crash. The log is not fsynced;
+    durability across power loss comes from persist(wait=True), which the
+    sync loop calls whenever the change stream goes idle. Each snapshot
+    rotates the log to <state_file>.log.<generation>; the rotated log is
+    removed once the snapshot covering it has been written. On startup
+    the snapshot is loaded and any remaining logs are replayed on top of
+    it.
+    
+    Between full snapshots, persists write a small <state_file>.delta
+    holding only the resume tokens changed since the last full snapshot
+    plus the current stats. A delta is applied on load only if it was
+    written against the snapshot that is on disk.
     
-    State file format:
+    State file contents:
     {
         "resume_tokens": {
             "cstest.items": { "_data": "hex_string" },
@@ -59,15 +114,57 @@ class SyncState:
             }
         }
         self._changes_since_persist = 0
+        self._log_path = self.state_file.with_name(self.state_file.name + ".log")
+        self._delta_path = self.state_file.with_name(self.state_file.name + ".delta")
+        self._log_generation = 0
+        # Collections whose token changed since the last full snapshot
+        self._dirty: Set[str] = set()
+        self._snapshot_generation: Optional[int] = None
+        # Start with a full snapshot to fold any delta/log from a previous run
+        self._persists_since_snapshot = FULL_SNAPSHOT_INTERVAL
+        # Set when stats or the token set change outside update_resume_token();
+        # the first persist always writes, folding any delta/log into a snapshot
+        self._unpersisted = True
+        # Set by the writer thread: the last write failed (re-raised to
+        # persist(wait=True) callers), and whether a full snapshot must be
+        # rewritten because the one on disk is missing or stale
+        self._write_error: Optional[Exception] = None
+        self._needs_snapshot = False
         self._load()
+        self._bind_state()
+        
+        self.state_file.parent.mkdir(parents=True, exist_ok=True)
+        self._log = open(self._log_path, 'ab', buffering=0)
+        
+        # Disk writes happen on a background thread so the change stream
+        # consumer never blocks on file I/O. The queue holds at most one
+        # pending write; a newer write replaces one not yet written.
+        self._writer_q: "queue.Queue[Optional[Tuple[str, Dict[str, Any], int]]]" = queue.Queue(maxsize=1)
+        self._writer = threading.Thread(
+            target=self._writer_loop,
+            name="sync-state-writer",
+            daemon=True
+        )
+        self._writer.start()
     
     def _load(self) -> None:
         """Load state from file if it exists."""
-        if self.state_file.exists():
+        loaded_generation = 0
+        legacy_file = self.state_file.with_suffix(".json")
+        if not self.state_file.exists() and legacy_file != self.state_file and legacy_file.exists():
+            try:
+                with open(legacy_file, 'rb') as f:
+                    self._state.update(orjson.loads(f.read()))
+                logger.info(f"Migrated sync state from {legacy_file} to {self.state_file}")
+            except Exception as e:
+                logger.warning(f"Could not migrate legacy state file {legacy_file}: {e}")
+        elif self.state_file.exists():
             try:
-                with open(self.state_file, 'r') as f:
-                    loaded = json.load(f)
+                with open(self.state_file, 'rb') as f:
+                    loaded = msgpack.unpackb(f.read(), raw=False, object_hook=json_util.object_hook)
+                    self._snapshot_generation = loaded.pop("generation", None)
                     self._state.update(loaded)
+                loaded_generation = self._apply_delta() or self._snapshot_generation or 0
                 logger.info(f"Loaded sync state from {self.state_file}")
                 tokens = self._state.get("resume_tokens", {})
                 if tokens:
@@ -79,19 +176,155 @@ class SyncState:
                                f"Inserts: {stats.get('inserts', 0)}, "
                                f"Updates: {stats.get('updates', 0)}, "
                                f"Deletes: {stats.get('deletes', 0)}")
-            except json.JSONDecodeError as e:
+            except ValueError as e:
                 logger.warning(f"Corrupted state file, starting fresh: {e}")
             except Exception as e:
                 logger.warning(f"Could not load state file: {e}")
         else:
             logger.info(f"No existing state file at {self.state_file}, starting fresh sync")
+        
+        # Keep generations increasing across restarts so a stale delta can
+        # never match a newer snapshot
+        rotated = self._rotated_logs()
+        self._log_generation = max(rotated[-1][0] if rotated else 0, loaded_generation)
+        # Logs up to the loaded generation are already folded into the state;
+        # they remain only if the process died before the writer removed them,
+        # and replaying them would move tokens back
+        replayed = sum(
+            self._replay_log(path) for generation, path in rotated if generation > loaded_generation
+        )
+        replayed += self._replay_log(self._log_path)
+        if replayed:
+            logger.info(f"Replayed {replayed} resume token update(s) from token log")
+    
+    def _bind_state(self) -> None:
+        """
+        Cache direct references to the dicts updated on every change event.
+        
+        Must be called again whenever self._state or its sub-dicts are replaced.
+        """
+        self._resume_tokens: Dict[str, Any] = self._state["resume_tokens"]
+        self._stats: Dict[str, int] = self._state["sync_stats"]
+        for key in ("total_synced", *_OP_KEY.values()):
+            self._stats.setdefault(key, 0)
+    
+    def _apply_delta(self) -> Optional[int]:
+        """
+        Merge the delta file into the loaded snapshot if it belongs to it.
+        
+        Returns:
+            Generation of the applied delta, or None if none was applied.
+        """
+        if not self._delta_path.exists():
+            return None
+        try:
+            with open(self._delta_path, 'rb') as f:
+                delta = msgpack.unpackb(f.read(), raw=False, object_hook=json_util.object_hook)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load state delta, relying on token log: {e}")
+            return None
+        if delta.get("base_generation") != self._snapshot_generation:
+            # Left over from before the current snapshot was written
+            return None
+        self._state.setdefault("resume_tokens", {}).update(delta["resume_tokens"])
+        self._state["last_sync_time"] = delta["last_sync_time"]
+        self._state["sync_stats"] = delta["sync_stats"]
+        return delta.get("generation")
+    
+    def _rotated_logs(self) -> List[Tuple[int, Path]]:
+        """Return rotated token logs as (generation, path), oldest first."""
+        prefix = self._log_path.name + "."
+        rotated = []
+        for path in self.state_file.parent.glob(prefix + "*"):
+            suffix = path.name[len(prefix):]
+            if suffix.isdigit():
+                rotated.append((int(suffix), path))
+        return sorted(rotated)
+    
+    def _replay_log(self, path: Path) -> int:
+        """
+        Apply resume token updates from a token log on top of the loaded state.
+        
+        Returns:
+            Number of updates replayed.
+        """
+        if not path.exists():
+            return 0
+        tokens = self._state.setdefault("resume_tokens", {})
+        replayed = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json_util.loads(line)
+                except ValueError:
+                    # A torn final line from a crash mid-append
+                    logger.warning(f"Ignoring incomplete entry at end of {path}")
+                    break
+                tokens[entry["c"]] = entry["t"]
+                replayed += 1
+        return replayed
+    
+    def _writer_loop(self) -> None:
+        """Write queued snapshots and deltas until a None sentinel is received."""
+        written_snapshot = None
+        while True:
+            item = self._writer_q.get()
+            try:
+                if item is None:
+                    return
+                kind, payload, generation = item
+                if kind == "snapshot":
+                    self._save(self.state_file, payload)
+                    written_snapshot = generation
+                else:
+                    self._save(self._delta_path, payload)
+                    if payload["base_generation"] != written_snapshot:
+                        # Its snapshot failed to write; keep the logs and
+                        # have the next persist write a full snapshot
+                        self._needs_snapshot = True
+                        self._write_error = None
+                        continue
+                # State on disk now covers every rotated log up to this generation
+                for log_generation, path in self._rotated_logs():
+                    if log_generation <= generation:
+                        path.unlink()
+                self._write_error = None
+            except Exception as e:
+                logger.error(f"Failed to persist state to {self.state_file}: {e}")
+                self._write_error = e
+                self._needs_snapshot = True
+            finally:
+                self._writer_q.task_done()
+    
+    def _enqueue(self, item: Tuple[str, Dict[str, Any], int]) -> None:
+        """Queue a write for the writer, replacing any unwritten one."""
+        try:
+            self._writer_q.put_nowait(item)
+        except queue.Full:
+            try:
+                pending = self._writer_q.get_nowait()
+            except queue.Empty:
+                self._writer_q.put_nowait(item)
+                return
+            self._writer_q.task_done()
+            if pending[0] == "snapshot" and item[0] == "delta":
+                # The delta only covers changes since that snapshot, so the
+                # snapshot must still be written first
+                self._writer_q.put_nowait(pending)
+                self._writer_q.put(item)
+            else:
+                self._writer_q.put_nowait(item)
     
-    def _save(self) -> None:
+    def _save(self, path: Path, payload: Dict[str, Any]) -> None:
         """
-        Atomically save state to file.
+        Atomically save a snapshot or delta to file.
         
         Uses write-to-temp-then-rename pattern for crash safety.
         """
+        # strict_types sends bytes subclasses like bson.Binary to the default
+        # hook instead of packing them as plain bytes
+        data = msgpack.packb(payload, use_bin_type=True, strict_types=True, default=_bson_default)
+        
         # Ensure parent directory exists
         self.state_file.parent.mkdir(parents=True, exist_ok=True)
         
@@ -102,12 +335,20 @@ class SyncState:
             suffix='.tmp'
         )
         try:
-            with os.fdopen(fd, 'w') as f:
-                json.dump(self._state, f, indent=2, default=str)
+            try:
+                # Write straight to the descriptor (no buffered file object)
+                # and flush the data before the rename can make it visible
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+                _sync_file_data(fd)
+            finally:
+                os.close(fd)
             
             # Atomic replace (works on both Windows and POSIX)
-            os.replace(temp_path, self.state_file)
-            logger.debug(f"State persisted to {self.state_file}")
+            os.replace(temp_path, path)
+            self._sync_dir()
+            logger.debug(f"State persisted to {path}")
         except Exception as e:
             # Clean up temp file on failure
             try:
@@ -116,6 +357,21 @@ class SyncState:
                 pass
             raise e
     
+    def _sync_dir(self) -> None:
+        """
+        Flush the state directory so a completed rename survives a crash.
+        
+        Directories can't be opened for fsync on Windows, where the rename
+        itself is already durable.
+        """
+        if os.name == 'nt':
+            return
+        dir_fd = os.open(self.state_file.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    
     def init_collections(self, collections: list) -> None:
         """
         Initialize resume tokens for the given collections.
@@ -127,10 +383,11 @@ class SyncState:
         Args:
             collections: List of "database.collection" strings to watch
         """
-        tokens = self._state.setdefault("resume_tokens", {})
+        tokens = self._resume_tokens
         for coll in collections:
             if coll not in tokens:
                 tokens[coll] = None
+                self._unpersisted = True
                 logger.info(f"  Initialized resume token for {coll} (fresh start)")
             else:
                 token = tokens[coll]
@@ -140,7 +397,7 @@ class SyncState:
                 else:
                     logger.info(f"  No resume token for {coll} (fresh start)")
         # Persist immediately so state file exists before consuming changes
-        self.persist()
+        self.persist(wait=True)
         logger.info(f"State file initialized with {len(collections)} collection(s)")
     
     def get_resume_token(self, collection: str) -> Optional[Dict[str, Any]]:
@@ -153,25 +410,23 @@ class SyncState:
         Returns:
             Resume token dict, or None if starting fresh.
         """
-        return self._state.get("resume_tokens", {}).get(collection)
+        return self._resume_tokens.get(collection)
     
-    def update_resume_token(self, collection: str, token: Dict[str, Any], persist_interval: int = 10) -> None:
+    def update_resume_token(self, collection: str, token: Dict[str, Any]) -> None:
         """
         Update the resume token for a specific collection.
         
+        The token is kept in memory and appended to the token log; call
+        persist() to write it to the state file.
+        
         Args:
             collection: The "database.collection" string
             token: The resume token from the change event (_id field)
-            persist_interval: Persist to disk every N changes
         """
-        self._state.setdefault("resume_tokens", {})[collection] = token
-        self._state["last_sync_time"] = datetime.utcnow().isoformat() + "Z"
+        self._resume_tokens[collection] = token
+        self._dirty.add(collection)
+        self._log.write(orjson.dumps({"c": collection, "t": token}, default=_bson_default) + b"\n")
         self._changes_since_persist += 1
-        
-        # Periodic persistence to balance durability and performance
-        if self._changes_since_persist >= persist_interval:
-            self.persist()
-            self._changes_since_persist = 0
     
     def record_operation(self, operation_type: str) -> None:
         """
@@ -180,38 +435,93 @@ class SyncState:
         Args:
             operation_type: One of 'insert', 'update', 'replace', 'delete', 'error'
         """
-        stats = self._state["sync_stats"]
-        stats["total_synced"] = stats.get("total_synced", 0) + 1
-        
-        if operation_type in ("insert",):
-            stats["inserts"] = stats.get("inserts", 0) + 1
-        elif operation_type in ("update", "replace"):
-            stats["updates"] = stats.get("updates", 0) + 1
-        elif operation_type == "delete":
-            stats["deletes"] = stats.get("deletes", 0) + 1
-        elif operation_type == "error":
-            stats["errors"] = stats.get("errors", 0) + 1
-    
-    def persist(self) -> None:
-        """Force immediate persistence of state to disk."""
-        self._save()
+        stats = self._stats
+        stats["total_synced"] += 1
+        key = _OP_KEY.get(operation_type)
+        if key is not None:
+            stats[key] += 1
+        self._unpersisted = True
+    
+    def persist(self, wait: bool = False) -> None:
+        """
+        Persist a snapshot of the current state to disk.
+        
+        The token log is rotated so that new updates go to a fresh log;
+        the write happens on the background writer thread.
+        
+        Args:
+            wait: Block until the snapshot has been written
+        
+        Raises:
+            Exception: With wait=True, the error from the last write if it failed.
+        """
+        if self._needs_snapshot:
+            # A previous write failed: write everything again as a snapshot
+            self._needs_snapshot = False
+            self._unpersisted = True
+            self._persists_since_snapshot = FULL_SNAPSHOT_INTERVAL
+        
+        # last_sync_time only needs second-level freshness, so it is stamped
+        # here rather than on every change event
+        if self._changes_since_persist > 0:
+            self._state["last_sync_time"] = _utc_timestamp()
+        
+        # Skip all disk I/O when nothing changed since the last persist
+        if not self._unpersisted and self._changes_since_persist == 0:
+            logger.debug("State unchanged since last persist, skipping write")
+            if wait:
+                self._wait_for_writer()
+            return
+        self._unpersisted = False
+        
+        self._log.close()
+        self._log_generation += 1
+        os.replace(self._log_path, self._log_path.with_name(f"{self._log_path.name}.{self._log_generation}"))
+        self._log = open(self._log_path, 'ab', buffering=0)
+        
+        if self._persists_since_snapshot >= FULL_SNAPSHOT_INTERVAL:
+            snapshot = copy.deepcopy(self._state)
+            snapshot["generation"] = self._log_generation
+            self._snapshot_generation = self._log_generation
+            self._dirty.clear()
+            self._persists_since_snapshot = 0
+            self._enqueue(("snapshot", snapshot, self._log_generation))
+        else:
+            tokens = self._resume_tokens
+            delta = {
+                "generation": self._log_generation,
+                "base_generation": self._snapshot_generation,
+                "resume_tokens": {c: tokens[c] for c in self._dirty},
+                "last_sync_time": self._state["last_sync_time"],
+                "sync_stats": dict(self._stats)
+            }
+            self._persists_since_snapshot += 1
+            self._enqueue(("delta", delta, self._log_generation))
         self._changes_since_persist = 0
-        logger.debug("State persisted to disk")
+        if wait:
+            self._wait_for_writer()
+        logger.debug("State queued for persistence")
     
-    def flush_if_pending(self) -> None:
+    def _wait_for_writer(self) -> None:
+        """Block until queued writes are done; re-raise the last write failure."""
+        self._writer_q.join()
+        if self._write_error is not None:
+            raise self._write_error
+    
+    def get_last_sync_time(self) -> Optional[str]:
         """
-        Persist state to disk if there are unpersisted changes.
+        Get the time of the last synced change as an ISO 8601 UTC string.
         
-        Call this when the change stream is idle to ensure tokens are
-        flushed even when the number of changes is less than persist_interval.
+        The stored value is only refreshed on persist; if changes have been
+        synced since then, the current time is returned instead.
         """
         if self._changes_since_persist > 0:
-            logger.info(f"Persisting resume tokens to state file for {self._changes_since_persist} change(s)")
-            self.persist()
+            return _utc_timestamp()
+        return self._state["last_sync_time"]
     
     def get_stats(self) -> Dict[str, int]:
         """Get current sync statistics."""
-        return self._state.get("sync_stats", {}).copy()
+        return self._stats.copy()
     
     def reset(self) -> None:
         """Reset state to start fresh (use with caution)."""
@@ -226,7 +536,25 @@ class SyncState:
                 "errors": 0
             }
         }
+        self._bind_state()
         self._changes_since_persist = 0
+        self._dirty.clear()
+        self._persists_since_snapshot = FULL_SNAPSHOT_INTERVAL
+        self._unpersisted = True
+        # Let any queued write land first so it can't recreate the file
+        self._writer_q.join()
+        self._log.truncate(0)
+        for _, path in self._rotated_logs():
+            path.unlink()
+        if self._delta_path.exists():
+            self._delta_path.unlink()
         if self.state_file.exists():
             self.state_file.unlink()
             logger.info("State reset - removed state file")
+    
+    def close(self) -> None:
+        """Write any queued snapshot and stop the background writer."""
+        self._writer_q.join()
+        self._writer_q.put(None)
+        self._writer.join()
+        self._log.close()
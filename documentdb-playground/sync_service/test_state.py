@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Crash-recovery tests for SyncState persistence.
+
+Run with:
+    python -m unittest test_state
+"""
+
+import os
+import tempfile
+import unittest
+
+from bson import Binary
+import orjson
+
+from state import FULL_SNAPSHOT_INTERVAL, SyncState
+
+
+def crash(state: SyncState) -> None:
+    """Simulate the process dying: let queued writes land, skip close()."""
+    state._writer_q.join()
+    state._log.close()
+
+
+class SyncStateRecoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.state_file = os.path.join(self._tmp.name, "state.mpk")
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_tokens_after_last_persist_are_replayed_from_log(self):
+        state = SyncState(self.state_file)
+        state.init_collections(["db.a", "db.b"])
+        state.update_resume_token("db.a", {"_data": "01"})
+        state.persist(wait=True)
+        state.update_resume_token("db.a", {"_data": "02"})
+        state.update_resume_token("db.b", {"_data": "03"})
+        crash(state)
+
+        state = SyncState(self.state_file)
+        self.assertEqual(state.get_resume_token("db.a"), {"_data": "02"})
+        self.assertEqual(state.get_resume_token("db.b"), {"_data": "03"})
+        state.close()
+
+    def test_deltas_between_snapshots_round_trip(self):
+        state = SyncState(self.state_file)
+        state.init_collections(["db.a", "db.b"])
+        for i in range(FULL_SNAPSHOT_INTERVAL + 3):
+            state.update_resume_token("db.a", {"_data": f"{i:04d}"})
+            state.record_operation("insert")
+            state.persist(wait=True)
+        state.update_resume_token("db.b", {"_data": "ffff"})
+        state.persist(wait=True)
+        crash(state)
+
+        state = SyncState(self.state_file)
+        self.assertEqual(state.get_resume_token("db.a"), {"_data": f"{FULL_SNAPSHOT_INTERVAL + 2:04d}"})
+        self.assertEqual(state.get_resume_token("db.b"), {"_data": "ffff"})
+        self.assertEqual(state.get_stats()["inserts"], FULL_SNAPSHOT_INTERVAL + 3)
+        state.close()
+
+    def test_rotated_logs_covered_by_state_are_not_replayed(self):
+        state = SyncState(self.state_file)
+        state.init_collections(["db.a"])
+        state.update_resume_token("db.a", {"_data": "01"})
+        state.persist(wait=True)
+        state.update_resume_token("db.a", {"_data": "02"})
+        state.persist(wait=True)
+        generation = state._log_generation
+        crash(state)
+
+        # A crash between writing the state and removing its rotated log
+        # leaves an older token behind
+        stale_log = f"{self.state_file}.log.{generation}"
+        with open(stale_log, "wb") as f:
+            f.write(orjson.dumps({"c": "db.a", "t": {"_data": "01"}}) + b"\n")
+
+        state = SyncState(self.state_file)
+        self.assertEqual(state.get_resume_token("db.a"), {"_data": "02"})
+        state.close()
+
+    def test_torn_log_line_is_ignored(self):
+        state = SyncState(self.state_file)
+        state.init_collections(["db.a"])
+        state.update_resume_token("db.a", {"_data": "01"})
+        crash(state)
+        with open(f"{self.state_file}.log", "ab") as f:
+            f.write(b'{"c": "db.a", "t": {"_da')
+
+        state = SyncState(self.state_file)
+        self.assertEqual(state.get_resume_token("db.a"), {"_data": "01"})
+        state.close()
+
+    def test_binary_tokens_keep_their_subtype(self):
+        token = {"_data": Binary(b"\x01\x02", 4)}
+        state = SyncState(self.state_file)
+        state.init_collections(["db.a", "db.b"])
+        state.update_resume_token("db.a", token)
+        state.persist(wait=True)
+        state.update_resume_token("db.b", token)
+        crash(state)
+
+        state = SyncState(self.state_file)
+        for coll in ("db.a", "db.b"):
+            restored = state.get_resume_token(coll)["_data"]
+            self.assertIsInstance(restored, Binary)
+            self.assertEqual(restored.subtype, 4)
+        state.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
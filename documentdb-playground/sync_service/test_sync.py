@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Tests for BulkBuffer, change dispatch and stream resume helpers.
+
+Run with:
+    python -m unittest test_sync
+"""
+
+import unittest
+
+from pymongo import DeleteOne, ReplaceOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from sync import BulkBuffer, oldest_resume_token, shared_stream_key, sync_change
+
+
+class FakeCollection:
+    """Records bulk_write calls; can fail the whole batch or single operations."""
+
+    def __init__(self, fail_batch: bool = False, fail_op=None):
+        self.calls = []
+        self.fail_batch = fail_batch
+        self.fail_op = fail_op
+
+    def bulk_write(self, requests, ordered=True):
+        self.calls.append((list(requests), ordered))
+        if len(requests) > 1 and self.fail_batch:
+            raise BulkWriteError({"writeErrors": [{"index": 0}], "nInserted": 0})
+        if self.fail_op is not None and self.fail_op in requests:
+            raise OperationFailure("write failed")
+
+
+class FakeDatabase:
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def __getitem__(self, coll_name):
+        return self.client.collections.setdefault((self.name, coll_name), FakeCollection())
+
+    def drop_collection(self, coll_name):
+        self.client.dropped.append(f"{self.name}.{coll_name}")
+
+
+class FakeClient:
+
+    def __init__(self):
+        self.collections = {}
+        self.dropped = []
+
+    def __getitem__(self, db_name):
+        return FakeDatabase(self, db_name)
+
+    def drop_database(self, db_name):
+        self.dropped.append(db_name)
+
+
+class FakeState:
+    """Records the SyncState calls BulkBuffer makes."""
+
+    def __init__(self):
+        self.tokens = {}
+        self.operations = []
+        self.persists = []
+
+    def update_resume_token(self, collection, token):
+        self.tokens[collection] = token
+
+    def record_operation(self, operation_type):
+        self.operations.append(operation_type)
+
+    def persist(self, wait=False):
+        self.persists.append(wait)
+
+
+class BulkBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeClient()
+        self.state = FakeState()
+        self.buffer = BulkBuffer(self.client, self.state)
+
+    def test_flush_writes_in_stream_order_then_persists_tokens(self):
+        delete = DeleteOne({"_id": 1})
+        replace = ReplaceOne({"_id": 1}, {"_id": 1, "v": 2}, upsert=True)
+        self.buffer.add("db", "a", "delete", delete)
+        self.buffer.add("db", "a", "insert", replace)
+        self.buffer.stage_token("db.a", {"_data": "01"})
+
+        self.assertTrue(self.buffer.flush(wait=True))
+        self.assertEqual(self.client.collections[("db", "a")].calls, [([delete, replace], True)])
+        self.assertEqual(self.state.tokens, {"db.a": {"_data": "01"}})
+        self.assertEqual(self.state.operations, ["delete", "insert"])
+        self.assertEqual(self.state.persists, [True])
+        self.assertEqual(len(self.buffer), 0)
+
+    def test_failed_batch_is_retried_one_operation_at_a_time(self):
+        collection = self.client.collections[("db", "a")] = FakeCollection(fail_batch=True)
+        ops = [DeleteOne({"_id": i}) for i in range(3)]
+        for op in ops:
+            self.buffer.add("db", "a", "delete", op)
+        self.buffer.stage_token("db.a", {"_data": "01"})
+
+        self.assertTrue(self.buffer.flush())
+        self.assertEqual(collection.calls[1:], [([op], True) for op in ops])
+        self.assertEqual(self.state.tokens, {"db.a": {"_data": "01"}})
+
+    def test_failed_operation_discards_staged_tokens(self):
+        ops = [DeleteOne({"_id": i}) for i in range(3)]
+        self.client.collections[("db", "a")] = FakeCollection(fail_batch=True, fail_op=ops[1])
+        for op in ops:
+            self.buffer.add("db", "a", "delete", op)
+        self.buffer.stage_token("db.a", {"_data": "01"})
+
+        self.assertFalse(self.buffer.flush())
+        self.assertEqual(self.state.tokens, {})
+        self.assertEqual(self.state.persists, [])
+        self.assertEqual(self.state.operations, ["error"])
+
+        # The failed batch is not retried by the next flush
+        self.assertTrue(self.buffer.flush())
+        self.assertEqual(self.state.persists, [])
+
+    def test_operation_failure_on_batch_discards_staged_tokens(self):
+        op = DeleteOne({"_id": 1})
+        self.client.collections[("db", "a")] = FakeCollection(fail_op=op)
+        self.buffer.add("db", "a", "delete", op)
+        self.buffer.stage_token("db.a", {"_data": "01"})
+
+        self.assertFalse(self.buffer.flush())
+        self.assertEqual(self.state.tokens, {})
+        self.assertEqual(self.state.persists, [])
+
+
+class ChangeDispatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeClient()
+        self.state = FakeState()
+        self.buffer = BulkBuffer(self.client, self.state)
+
+    def sync(self, change):
+        return sync_change(change, self.client, self.state, {}, self.buffer)
+
+    def test_insert_and_delete_are_staged(self):
+        ns = {"db": "db", "coll": "a"}
+        self.assertTrue(self.sync({
+            "operationType": "insert", "ns": ns,
+            "documentKey": {"_id": 1}, "fullDocument": {"_id": 1, "v": 1},
+        }))
+        self.assertTrue(self.sync({"operationType": "delete", "ns": ns, "documentKey": {"_id": 1}}))
+        self.assertEqual(len(self.buffer), 2)
+
+        self.buffer.flush()
+        (requests, _), = self.client.collections[("db", "a")].calls
+        self.assertEqual(
+            requests, [ReplaceOne({"_id": 1}, {"_id": 1, "v": 1}, upsert=True), DeleteOne({"_id": 1})]
+        )
+
+    def test_drop_flushes_staged_writes_first(self):
+        ns = {"db": "db", "coll": "a"}
+        self.sync({"operationType": "delete", "ns": ns, "documentKey": {"_id": 1}})
+        self.assertTrue(self.sync({"operationType": "drop", "ns": ns}))
+        self.assertEqual(len(self.client.collections[("db", "a")].calls), 1)
+        self.assertEqual(self.client.dropped, ["db.a"])
+
+    def test_drop_database_does_not_drop_the_target_database(self):
+        self.assertTrue(self.sync({"operationType": "dropDatabase", "ns": {"db": "db"}}))
+        self.assertEqual(self.client.dropped, [])
+
+    def test_invalidate_stops_sync(self):
+        self.assertFalse(self.sync({"operationType": "invalidate", "_id": {"_data": "01"}}))
+
+    def test_unknown_operation_is_ignored(self):
+        self.assertTrue(self.sync({"operationType": "rename", "ns": {"db": "db", "coll": "a"}}))
+        self.assertEqual(len(self.buffer), 0)
+
+
+class ResumeTokenHelpersTest(unittest.TestCase):
+
+    def test_shared_stream_key_is_order_independent(self):
+        self.assertEqual(shared_stream_key("db", ["b", "a"]), shared_stream_key("db", ["a", "b"]))
+        self.assertNotIn(shared_stream_key("db", ["a", "b"]), ("db.a", "db.b"))
+
+    def test_oldest_resume_token_ignores_missing_tokens(self):
+        self.assertEqual(
+            oldest_resume_token([{"_data": "05"}, None, {"_data": "03"}]), {"_data": "03"}
+        )
+        self.assertIsNone(oldest_resume_token([None, None]))
+
+
+if __name__ == "__main__":
+    unittest.main()